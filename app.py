@@ -2,9 +2,13 @@ from dotenv import load_dotenv
 import chainlit as cl
 from movie_functions import get_showtimes, get_now_playing_movies, get_reviews, get_random_movie, buy_ticket, confirm_ticket_purchase
 import json
+import asyncio
+import logging
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Note: If switching to LangSmith, uncomment the following, and replace @observe with @traceable
 # from langsmith.wrappers import wrap_openai
 # from langsmith import traceable
@@ -76,6 +80,29 @@ rationale. Do not output as a code block.
 def on_chat_start():    
     message_history = [{"role": "system", "content": SYSTEM_PROMPT}]
     cl.user_session.set("message_history", message_history)
+    cl.user_session.set("current_turn", None)
+    cl.user_session.set("superseded_turns", set())
+    cl.user_session.set("cancel_stats", {
+        "turns_cancelled": 0,
+        "streams_closed": 0,
+        "tool_calls_detached": 0,
+        "messages_rolled_back": 0
+    })
+
+def record_cancel(stat, amount=1):
+    stats = cl.user_session.get("cancel_stats")
+    if stats is not None:
+        stats[stat] += amount
+
+def cancel_current_turn(superseded=False):
+    # Cancel the in-flight turn (if any) so it stops streaming and never writes its results to history
+    task = cl.user_session.get("current_turn")
+    if task is not None and not task.done():
+        if superseded:
+            cl.user_session.get("superseded_turns", set()).add(task)
+        task.cancel()
+        return True
+    return False
 
 @observe
 async def generate_response(client, message_history, gen_kwargs):
@@ -83,20 +110,79 @@ async def generate_response(client, message_history, gen_kwargs):
     await response_message.send()
 
     stream = await client.chat.completions.create(messages=message_history, stream=True, **gen_kwargs)
-    async for part in stream:
-        if token := part.choices[0].delta.content or "":
-            await response_message.stream_token(token)
+    try:
+        async for part in stream:
+            if token := part.choices[0].delta.content or "":
+                await response_message.stream_token(token)
+    except asyncio.CancelledError:
+        # OpenAI stops generating tokens we will never use once the stream is closed below
+        record_cancel("streams_closed")
+        raise
+    finally:
+        # Always release the HTTP response, but never let an error on close mask the original one
+        try:
+            await stream.close()
+        except Exception:
+            logger.exception("Error closing the OpenAI stream")
     
     await response_message.update()
 
     return response_message
 
+async def run_function(function, *args):
+    # The movie functions make blocking HTTP calls. Running them in a thread keeps the
+    # event loop free, so a cancelled turn can detach from them instead of waiting.
+    # A detached call is not aborted: it runs until its request timeout and its result is dropped.
+    try:
+        return await asyncio.to_thread(function, *args)
+    except asyncio.CancelledError:
+        record_cancel("tool_calls_detached")
+        raise
+
+@cl.on_stop
+def on_stop():
+    cancel_current_turn()
+
 @cl.on_message
-@observe
 async def on_message(message: cl.Message):
-    message_history = cl.user_session.get("message_history", [])
-    message_history.append({"role": "user", "content": message.content})
+    # A new message supersedes whatever turn is still running
+    cancel_current_turn(superseded=True)
 
+    task = asyncio.ensure_future(run_turn(message))
+    cl.user_session.set("current_turn", task)
+    try:
+        await task
+    except asyncio.CancelledError:
+        # Only swallow the cancellation of a superseded turn; a stop cancels on_message itself, so propagate it
+        if task not in cl.user_session.get("superseded_turns", set()):
+            raise
+    finally:
+        cl.user_session.get("superseded_turns", set()).discard(task)
+        if cl.user_session.get("current_turn") is task:
+            cl.user_session.set("current_turn", None)
+
+@observe
+async def run_turn(message: cl.Message):
+    # The user message is kept even if the turn is cancelled, so a follow-up still has the question it refers to
+    saved_history = cl.user_session.get("message_history", [])
+    saved_history.append({"role": "user", "content": message.content})
+    cl.user_session.set("message_history", saved_history)
+    # A superseding turn appends to the same list, so measure the rollback against this length
+    committed_len = len(saved_history)
+
+    # Work on a copy so a cancelled turn leaves the saved history untouched
+    message_history = list(saved_history)
+    try:
+        await process_turn(message_history)
+    except asyncio.CancelledError:
+        record_cancel("turns_cancelled")
+        record_cancel("messages_rolled_back", len(message_history) - committed_len)
+        logger.info("Turn cancelled. Cancel stats: %s", json.dumps(cl.user_session.get("cancel_stats")))
+        raise
+
+    cl.user_session.set("message_history", message_history)
+
+async def process_turn(message_history):
     message_history.append({"role": "system", "content": REVIEW_PROMPT})
     response_message = await generate_response(client, message_history, gen_kwargs)
 
@@ -105,7 +191,7 @@ async def on_message(message: cl.Message):
 
         if context_json.get("fetch_reviews", False):
             movie_id = context_json.get("id")
-            reviews = get_reviews(movie_id)
+            reviews = await run_function(get_reviews, movie_id)
             reviews = f"Reviews for {context_json.get('movie')} (ID: {movie_id}):\n\n{reviews}"
             context_message = {"role": "system", "content": f"CONTEXT: {reviews}"}
             message_history.append(context_message)
@@ -124,15 +210,15 @@ async def on_message(message: cl.Message):
             if function_name == "get_showtimes":
                 title = json_message.get("title")
                 location = json_message.get("location")
-                result = get_showtimes(title, location)
+                result = await run_function(get_showtimes, title, location)
             elif function_name == "get_now_playing_movies":
-                result = get_now_playing_movies()
+                result = await run_function(get_now_playing_movies)
             elif function_name == "get_random_movie":
                 movie_list = json_message.get("movies")
                 result = get_random_movie(movie_list)
             elif function_name == "get_reviews":
                 movie_id = json_message.get("movie_id")
-                result = get_reviews(movie_id)
+                result = await run_function(get_reviews, movie_id)
             elif function_name == "buy_tickets":
                 movie_id = json_message.get("movie_id")
                 theater = json_message.get("theater")
@@ -154,7 +240,6 @@ async def on_message(message: cl.Message):
             json_message = None
 
     message_history.append({"role": "assistant", "content": response_message.content})
-    cl.user_session.set("message_history", message_history)
 
 if __name__ == "__main__":
     cl.main()
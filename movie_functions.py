@@ -4,6 +4,9 @@ from serpapi import GoogleSearch
 import os
 import random
 
+# Seconds before an upstream API call gives up, so a detached call cannot hold a worker thread forever
+REQUEST_TIMEOUT = 10
+
 def get_random_movie(movie_list):
     if not movie_list:
         return None  # Return None if the list is empty
@@ -16,7 +19,10 @@ def get_now_playing_movies():
     headers = {
         "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
     }
-    response = requests.get(url, headers=headers)
+    try:
+        response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        return f"Error fetching data: {e}"
     
     if response.status_code != 200:
         return f"Error fetching data: {response.status_code} - {response.reason}"
@@ -55,7 +61,11 @@ def get_showtimes(title, location):
     }
 
     search = GoogleSearch(params)
-    results = search.get_dict()
+    search.timeout = REQUEST_TIMEOUT
+    try:
+        results = search.get_dict()
+    except requests.exceptions.RequestException as e:
+        return f"Error fetching showtimes for {title} in {location}: {e}"
 
     if 'showtimes' not in results:
         return f"No showtimes found for {title} in {location}."
@@ -91,7 +101,10 @@ def get_reviews(movie_id):
         "accept": "application/json",
         "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
     }
-    response = requests.get(url, headers=headers)
+    try:
+        response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        return f"Error fetching reviews: {e}"
     reviews_data = response.json()
 
     if 'results' not in reviews_data or not reviews_data['results']: